@@ -0,0 +1,226 @@
+# Definition of the cell result cache class ResultCache
+# Copyright (C) 2019 John L. Ries
+
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this module.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import hashlib
+import pickle
+import tempfile
+
+# Commands whose file arguments are read by SPM (USE, SUBMIT).
+__input_cmd__ = "(?im)^ *(USE|SUB[A-Z]*) +"
+# Commands that run another command file (SUBMIT).
+__submit_cmd__ = "(?im)^ *(SUB[A-Z]*) +"
+# Commands whose file arguments are written by SPM (GROVE, SAVE).  OUTPUT files are
+# left alone, since SPM keeps writing to them after the cell that opened them ends.
+__output_cmd__ = "(?im)^ *(GROVE|SAVE) +"
+# Commands that grow or name a grove file (GROVE).
+__grove_cmd__ = "(?im)^ *(GROVE) +"
+# Commands that only set up the session (data, variables and options), which are cheap
+# to run again.  SPM accepts any abbreviation of at least three letters.
+__state_cmds__ = ["USE", "SEED", "KEEP", "EXCLUDE", "CATEGORY", "MODEL", "WEIGHT",
+                  "IDVAR", "AUXILIARY", "LIMIT", "PARTITION", "PENALTY", "PRIORS",
+                  "MISCLASS", "METHOD", "ERROR", "LOPTIONS", "BOPTIONS", "FORMAT",
+                  "MEMORY", "CLASS", "LABELS", "LINEAR"]
+# Engine commands set the engine's options, unless they include GO (which builds a model).
+__engine_cmds__ = ["CART", "MART", "TREENET", "RF", "RANDOMFOREST", "MARS", "GPS"]
+# A file name, either quoted or bare
+__filename__ = "(?:'([^']*)'|\"([^\"]*)\"|([^\\s'\"]+))"
+
+class ResultCache(object):
+  """On-disk store of captured cell results, keyed by a fingerprint of the cell."""
+
+  suffix = ".pkl" # Extension given to each cache entry
+
+  def __init__(self, directory, max_bytes):
+    # directory is where the cache entries are kept.  It is created if necessary.
+    # max_bytes is the maximum total size of the entries.  The least recently used
+    #   entries are discarded when it is exceeded.
+    self.directory = directory
+    self.max_bytes = max_bytes
+    os.makedirs(directory, exist_ok=True)
+
+  # Hash an arbitrary sequence of strings into a hex digest
+  @staticmethod
+  def digest(*parts):
+    sha = hashlib.sha256()
+    for part in parts:
+      sha.update(str(part).encode("utf-8"))
+      sha.update(b"\0") # Keep ("ab", "c") distinct from ("a", "bc")
+    return sha.hexdigest()
+
+  # Return the list of file names given as arguments to the commands matching cmd
+  @staticmethod
+  def files(code, cmd):
+    names = []
+    for match in re.finditer(cmd + __filename__, code):
+      name = match.group(2) or match.group(3) or match.group(4)
+      if name:
+        names.append(os.path.abspath(os.path.expanduser(name)))
+    return names
+
+  # Like files, but also search any command files code SUBMITs (and any they
+  # SUBMIT, and so on)
+  @classmethod
+  def submitted_files(cls, code, cmd, seen = None):
+    # seen lists the command files already scanned, so that we don't loop forever.
+    if seen is None:
+      seen = []
+    names = cls.files(code, cmd)
+    for path in cls.files(code, __submit_cmd__):
+      if path in seen or not os.path.isfile(path):
+        continue
+      seen.append(path)
+      with open(path, errors="replace") as fd:
+        names.extend(cls.submitted_files(fd.read(), cmd, seen))
+    return names
+
+  # Return the list of input files named in code or the command files it SUBMITs
+  @classmethod
+  def input_files(cls, code):
+    return cls.submitted_files(code, __input_cmd__)
+
+  # Return the lines of code that set up the session, rather than building or
+  # reporting on models.  SUBMIT'ted command files are searched in the same way.
+  @classmethod
+  def state_commands(cls, code, seen = None):
+    if seen is None:
+      seen = []
+    commands = []
+    for line in code.splitlines():
+      words = line.upper().replace("=", " ").replace(",", " ").split()
+      if not words:
+        continue
+      word = words[0]
+      if word.startswith("%"): # SPM BASIC transforms the data as it is read
+        commands.append(line)
+      elif len(word) >= 3 and [cmd for cmd in __state_cmds__ if cmd.startswith(word)]:
+        commands.append(line)
+      elif word in __engine_cmds__ and "GO" not in words:
+        commands.append(line)
+      elif re.match(__submit_cmd__, line):
+        for path in cls.files(line, __submit_cmd__):
+          if path not in seen and os.path.isfile(path):
+            seen.append(path)
+            with open(path, errors="replace") as fd:
+              commands.extend(cls.state_commands(fd.read(), seen))
+    return commands
+
+  # Return the list of grove files named in code or the command files it SUBMITs
+  @classmethod
+  def grove_files(cls, code):
+    return cls.submitted_files(code, __grove_cmd__)
+
+  # Return the list of output files (groves, saved datasets) named in code or
+  # the command files it SUBMITs
+  @classmethod
+  def output_files(cls, code):
+    return cls.submitted_files(code, __output_cmd__)
+
+  # Fingerprint a file by name, size, modification time and content hash
+  @staticmethod
+  def fingerprint(path):
+    if not os.path.isfile(path):
+      return (path, None)
+    stat = os.stat(path)
+    sha = hashlib.sha256()
+    with open(path, "rb") as fd:
+      for block in iter(lambda: fd.read(1 << 20), b""):
+        sha.update(block)
+    return (path, stat.st_size, stat.st_mtime_ns, sha.hexdigest())
+
+  # Return the files that must be written to restore entry, or None if it can't be
+  # restored because a file the cell names in a GROVE or SAVE command is neither as
+  # the cell found it nor as the cell left it.  (It may have been rebuilt since, or
+  # be a grove the cell only read.)
+  @classmethod
+  def stale_files(cls, entry):
+    outputs = entry.get("outputs")
+    if outputs is None: # Entry from an older version
+      return None
+    stale = []
+    for path, (before, after) in outputs.items():
+      current = cls.fingerprint(path)[-1]
+      if current not in (before, after):
+        return None
+      if current != after:
+        stale.append(path)
+    return stale
+
+  # Compute the cache key for code given the session context
+  def key(self, code, context):
+    # code is the text of the cell.
+    # context is a tuple describing the session state (ECHO setting, table row
+    #   limit, prior cells).
+    # Files read by the cell, directly or through SUBMIT, are fingerprinted by content.
+    inputs = [self.fingerprint(path) for path in self.input_files(code)]
+    return self.digest(code, context, inputs)
+
+  def path(self, key):
+    return os.path.join(self.directory, key + self.suffix)
+
+  # Return the entry stored under key, or None if there isn't one
+  def get(self, key):
+    path = self.path(key)
+    try:
+      with open(path, "rb") as fd:
+        entry = pickle.load(fd)
+      os.utime(path) # Mark the entry as recently used
+    except Exception:
+      # Missing, evicted by another kernel, corrupt, or pickled from classes that
+      # have since changed.  Either way, the cell has to be run again.
+      return None
+    return entry
+
+  # Store entry under key, then trim the cache to size
+  def put(self, key, entry):
+    fd, tmpname = tempfile.mkstemp(dir=self.directory)
+    with os.fdopen(fd, "wb") as out:
+      pickle.dump(entry, out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpname, self.path(key))
+    self.evict()
+
+  # Discard least recently used entries until the cache fits in max_bytes
+  def evict(self):
+    entries = []
+    total = 0
+    for name in os.listdir(self.directory):
+      if name.endswith(self.suffix):
+        stat = os.stat(os.path.join(self.directory, name))
+        entries.append((stat.st_mtime, stat.st_size, name))
+        total = total + stat.st_size
+    entries.sort()
+    while entries and total > self.max_bytes:
+      mtime, size, name = entries.pop(0)
+      os.remove(os.path.join(self.directory, name))
+      total = total - size
+
+  # Remove every entry; returns the number removed
+  def clear(self):
+    count = 0
+    for name in os.listdir(self.directory):
+      if name.endswith(self.suffix):
+        os.remove(os.path.join(self.directory, name))
+        count = count + 1
+    return count
+
+  # Total size of the entries in bytes
+  def size(self):
+    total = 0
+    for name in os.listdir(self.directory):
+      if name.endswith(self.suffix):
+        total = total + os.path.getsize(os.path.join(self.directory, name))
+    return total
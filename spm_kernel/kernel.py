@@ -22,6 +22,7 @@ from metakernel.process_metakernel import TextOutput
 from metakernel.process_metakernel import REPLWrapper
 import io
 import re
+import math
 import os
 import xmltodict
 import xml.parsers.expat
@@ -35,12 +36,28 @@ from pexpect import EOF
 from ordered_set import OrderedSet
 
 from spm_kernel.version import __version__
+from spm_kernel.cache import ResultCache
 
 # Useful constants
 __SPM__ = 'spmu'   # SPM exec.  Eventually, we'll allow this to be set by the installer.
 __prompt__ = ' >'  # The SPM carat prompt.
                    # We need this so that pexpect can find the end of the output.
 __echo__ = True    # Send SPM console output to Jupyter.
+__maxread__ = 65536    # Characters to read from SPM at a time
+__searchwindow__ = 4096 # Characters at the end of the output searched for the prompt
+# Once SPM is running, we only accept the prompt right after a line break, or at the
+# start of the output (when a command prints nothing else).  pexpect searches a window
+# cut from the end of the output, which may start mid-line; but a window shorter than
+# __searchwindow__ always holds all of the output, so then its start is the output's.
+__prompt_re__ = "(?<=[\r\n]) >|\\A(?=[\\s\\S]{0,%d}\\Z) >" % (__searchwindow__ - 1)
+# Where $CACHE keeps memoized cell results, and how large (in bytes) it may grow.
+__cache_dir__ = os.environ.get("SPM_KERNEL_CACHE_DIR",
+                               os.path.join(os.path.expanduser("~"), ".cache", "spm_kernel"))
+__cache_size__ = os.environ.get("SPM_KERNEL_CACHE_SIZE", "").strip()
+if not __cache_size__.isdigit(): # Unset, or not a whole number of megabytes
+  __cache_size__ = "1024"
+__cache_size__ = int(__cache_size__) * 1024 * 1024
+__table_rows__ = 25 # Rows shown from each end of a long table (0 to show them all).
 
 # I'll confess that I copied this from gnuplot_kernel (my initial model)
 # and don't know exactly what it does.
@@ -50,6 +67,105 @@ except NameError:
   # Python 2
   FileNotFoundError = OSError
 
+class TableOutput(object):
+  """An SPM table parsed into cells, displayed both as HTML and as a tabular data resource."""
+
+  def __init__(self, title, head, body, foot, nrows = 0):
+    # title is the table caption (may be empty).
+    # head is the list of column titles.
+    # body and foot are lists of rows, each a list of cells.
+    # nrows is the number of rows to show from each end of the body.  If the body is
+    #   longer than twice that, the rows in between are left out.  0 shows every row.
+    self.title = title
+    self.head = head
+    self.body = body
+    self.foot = foot
+    self.nrows = nrows
+
+  # Return the body rows to be shown and the number left out
+  def rows(self):
+    nrows = self.nrows
+    nbody = len(self.body)
+    if nrows > 0 and nbody > 2 * nrows:
+      return self.body[:nrows] + self.body[-nrows:], nbody - 2 * nrows
+    return self.body, 0
+
+  def _repr_html_(self):
+    rows, omitted = self.rows()
+    ncol = len(self.head)
+    html = ["<table>"]
+    if len(self.title) > 0:
+      html.append("<caption>" + self.title + "</caption>")
+    html.append("<thead><tr>")
+    for header in self.head: # Column titles are bolded
+      html.append("<th>" + header + "</th>")
+    html.append("</tr></thead><tbody>")
+    for irow in range(len(rows)):
+      if omitted and irow == self.nrows: # Mark where the omitted rows belong
+        html.append("<tr><td colspan=" + str(ncol) + " style='text-align:center'>... " +
+                    str(omitted) + " rows omitted (use $TABLE to show all) ...</td></tr>")
+      html.append("<tr>")
+      for cell in rows[irow]:
+        html.append("<td>" + cell + "</td>")
+      html.append("</tr>")
+    html.append("</tbody>")
+    if len(self.foot) > 0:
+      html.append("<tfoot>")
+      for row in self.foot:
+        html.append("<tr>")
+        # We also bold the first cell in each row of the footer
+        html.append("<th>" + row[0] + "</th>")
+        for icol in range(1, ncol):
+          html.append("<td>" + row[icol] + "</td>")
+        html.append("</tr>")
+      html.append("</tfoot>")
+    html.append("</table>")
+    return "".join(html)
+
+  # Render the shown rows as an application/vnd.dataresource+json document
+  def resource(self):
+    rows, omitted = self.rows()
+    # Field names must be unique and non-empty
+    names = []
+    for icol in range(len(self.head)):
+      name = self.head[icol].strip() or "Column " + str(icol + 1)
+      while name in names:
+        name = name + "_"
+      names.append(name)
+    # Columns in which every non-blank cell is a finite number are typed as numbers.
+    # (JSON has no representation for NaN or infinity.)
+    fields = []
+    for icol in range(len(names)):
+      numeric = True
+      for row in rows:
+        cell = row[icol].strip()
+        try:
+          if cell and not math.isfinite(float(cell)):
+            numeric = False
+        except ValueError:
+          numeric = False
+        if not numeric:
+          break
+      fields.append({"name": names[icol], "type": "number" if numeric else "string"})
+    data = []
+    for row in rows:
+      record = {}
+      for icol in range(len(names)):
+        cell = row[icol].strip()
+        if fields[icol]["type"] == "number":
+          record[names[icol]] = float(cell) if cell else None
+        else:
+          record[names[icol]] = cell
+      data.append(record)
+    return {"title": self.title.strip(), "schema": {"fields": fields}, "data": data}
+
+  def _repr_mimebundle_(self, include = None, exclude = None):
+    return {"text/html": self._repr_html_(),
+            "application/vnd.dataresource+json": self.resource()}
+
+  def __repr__(self):
+    return self.title.strip() + " (" + str(len(self.body)) + " rows)"
+
 class SPMKernel(ProcessMetaKernel):
   implementation = 'SPM Kernel'
   implementation_version = __version__
@@ -81,11 +197,25 @@ class SPMKernel(ProcessMetaKernel):
     MetaKernel.__init__(self, *args, **kwargs)
     self.wrapper = None
     self.wrapper = self.makeWrapper()
+    self.cache = None           # ResultCache, if enabled by $CACHE ON
+    self._cache_history = ""    # Fingerprint of the cells run so far this session
+    self._cache_pending = []    # Session commands from cached cells not yet run by SPM
+    self._cache_records = None  # Output captured from the current cell, if caching
+    self._last_table = None     # The most recently displayed TableOutput, for $TABLE
     #self.log.setLevel(logging.DEBUG) # Uncomment to show debug writes
 
   # Start SPM session
   def makeWrapper(self):
-    return REPLWrapper(__SPM__, __prompt__, None)
+    wrapper = REPLWrapper(__SPM__, __prompt__, None)
+    # By default, pexpect reads 2000 characters at a time and searches everything
+    # received since the last prompt after each read, so the time taken to collect
+    # the output grows with the square of its size.  Since the prompt always comes
+    # last, we read bigger chunks and only search the end of the output.
+    child = wrapper.child
+    child.maxread = __maxread__
+    child.searchwindowsize = __searchwindow__
+    wrapper.prompt_regex = __prompt_re__
+    return wrapper
 
   # Extract specified XML/HTML element from input
   def extract(self, input, starttag, endtag):
@@ -98,6 +228,120 @@ class SPMKernel(ProcessMetaKernel):
     finlen = len(endtag)
     return input[start : finish + finlen]
 
+  # Display objects, recording them if the current cell's results are being cached
+  def Display(self, *objects, **kwargs):
+    for item in objects:
+      if isinstance(item, TableOutput):
+        self._last_table = item
+    if self._cache_records is not None:
+      self._cache_records.append(("display", objects, kwargs))
+    super(SPMKernel, self).Display(*objects, **kwargs)
+
+  # Process the $CACHE command and return a status message
+  def cache_command(self, code):
+    # $CACHE ON enables memoization of cell results, $CACHE OFF disables it,
+    # $CACHE CLEAR discards all stored results and $CACHE SIZE n sets the
+    # maximum size of the cache in megabytes.  With no arguments, the status is reported.
+    global __cache_size__
+    words = code.upper().split()
+    if len(words) > 1 and words[1] == "ON":
+      self.cache = ResultCache(__cache_dir__, __cache_size__)
+    elif len(words) > 1 and words[1] == "OFF":
+      self.cache = None
+    elif len(words) > 1 and words[1] == "CLEAR":
+      count = ResultCache(__cache_dir__, __cache_size__).clear()
+      return "Removed " + str(count) + " cached results from " + __cache_dir__
+    elif len(words) > 1 and words[1] == "SIZE":
+      if len(words) != 3 or not words[2].isdigit():
+        return "Usage: $CACHE SIZE n, where n is the maximum size of the cache in megabytes"
+      __cache_size__ = int(words[2]) * 1024 * 1024
+      if self.cache is not None:
+        self.cache.max_bytes = __cache_size__
+        self.cache.evict()
+    elif len(words) > 1:
+      return "Usage: $CACHE [ON | OFF | CLEAR | SIZE n]"
+    if self.cache is None:
+      return "Result cache is off"
+    return "Result cache is on: " + __cache_dir__ + " (" + \
+      str(self.cache.size() // (1024 * 1024)) + " of " + \
+      str(self.cache.max_bytes // (1024 * 1024)) + " MB used)"
+
+  # Process the $TABLE command and return a status message, if any
+  def table_command(self, code):
+    # $TABLE displays every row of the most recent table; $TABLE ROWS n shows only
+    # the first and last n rows of subsequent tables (0 shows them all).
+    global __table_rows__
+    words = code.upper().split()
+    if len(words) > 1 and words[1] == "ROWS":
+      if len(words) != 3 or not words[2].isdigit():
+        return "Usage: $TABLE ROWS n, where n is the number of rows to show from each end"
+      __table_rows__ = int(words[2])
+      if __table_rows__ > 0:
+        return "Tables will show the first and last " + str(__table_rows__) + " rows"
+      return "Tables will show every row"
+    if len(words) > 1:
+      return "Usage: $TABLE [ROWS n]"
+    table = self._last_table
+    if table is None:
+      return "No table has been displayed yet."
+    self.Display(TableOutput(table.title, table.head, table.body, table.foot))
+
+  # Reproduce the results of a cell from a cache entry
+  def restore_cached(self, entry, stale, silent):
+    # stale lists the groves or other files the cell wrote that need to be put back
+    for path in stale:
+      if path in entry["files"]:
+        with open(path, "wb") as fd:
+          fd.write(entry["files"][path])
+      else: # The cell removed it
+        os.remove(path)
+    result = None
+    for record in entry["records"]:
+      if record[0] == "print" and not silent:
+        self.Print(record[1])
+      elif record[0] == "display":
+        self.Display(*record[1], **record[2])
+      elif record[0] == "text":
+        result = TextOutput(record[1])
+    return result
+
+  # Send SPM the session commands of the cells restored from the cache.
+  # Returns False (having reported the problem) if any of them fails.
+  def replay_cached(self):
+    pending = self._cache_pending
+    self._cache_pending = []
+    for command in pending:
+      try:
+        # Without a stream handler, the output is returned rather than displayed
+        output = self.wrapper.run_command(command, timeout=None)
+      except KeyboardInterrupt:
+        self.wrapper.interrupt()
+        self._cache_history = ""
+        self.kernel_resp = {
+            'status': 'abort',
+            'execution_count': self.execution_count,
+        }
+        return False
+      except EOF:
+        self._cache_history = ""
+        self.Print(self.wrapper.child.before)
+        self.do_shutdown(True)
+        return False
+      exitcode, trace = self.check_exitcode()
+      if exitcode or "*ERROR*" in output:
+        # SPM is no longer in the state the cache assumed, so later cells must miss
+        self._cache_history = ""
+        message = "Restoring the session from the result cache failed at: " + command
+        self.Error(message + "\n" + output)
+        self.kernel_resp = {
+            'status': 'error',
+            'execution_count': self.execution_count,
+            'ename': '', 'evalue': str(exitcode) if exitcode else message,
+            'traceback': trace or [message, output],
+        }
+        return False
+    return True
+
   # Generic function to display a figure inside of Jupyter
   # Thanks to Steven Silvester for helping me to work this out
   def display_figure(self, fig):
@@ -108,7 +352,7 @@ class SPMKernel(ProcessMetaKernel):
     width = fig.get_figwidth() * fig.dpi
     data = "<img src='data:image/png;base64,{0}' width={1}/>"
     data = data.format(b64encode(buf.getvalue()).decode('utf-8'), width)
-    super(SPMKernel, self).Display(HTML(data))
+    self.Display(HTML(data))
 
   # Generic function to extract the specified SPM text table from input,
   # format it as an HTML table and display it inside of Jupyter.
@@ -239,33 +483,8 @@ class SPMKernel(ProcessMetaKernel):
           cell.append(line[startcol[icol]:endcol[icol]])
         foot.append(cell)
 
-    # Render the table into HTML
-    html="<table>"
-    if len(title) > 0:
-      html = html + "<caption>" + title + "</caption>"
-    html = html + "<thead><tr>"
-    for header in head: # Column titles are bolded
-      html = html + "<th>" + header + "</th>"
-    html = html + "</tr></thead><tbody>"
-    for row in body:
-      html = html + "<tr>"
-      for cell in row:
-        html = html + "<td>" + cell + "</td>"
-      html + "</tr>"
-    html = html + "</tbody>"
-    if len(foot) > 0:
-      html = html + "<tfoot>"
-      for row in foot:
-        html = html + "<tr>"
-        # We also bold the first cell in each row of the footer
-        html = html + "<th>" + row[0] + "</th>"
-        for icol in range(1, ncol):
-          html = html + "<td>" + row[icol] + "</td>"
-        html = html + "</tr>"
-      html = html + "</tfoot>"
-    html = html + "</table>"
-
-    super(SPMKernel, self).Display(HTML(html)) # Display the table we just rendered
+    # Display the table we just parsed; long ones are abbreviated
+    self.Display(TableOutput(title, head, body, foot, __table_rows__))
     return found
 
   # Display variable importances as a bar plot
@@ -494,6 +713,14 @@ class SPMKernel(ProcessMetaKernel):
   def do_execute_direct(self, code, silent=False):
     """Execute the code in the subprocess.
     """
+    try:
+      return self.execute_cell(code, silent)
+    finally:
+      # Stop capturing output for the cache, even if the cell failed
+      self._cache_records = None
+
+  # The work of do_execute_direct
+  def execute_cell(self, code, silent):
     self.payload = []
     wrapper = self.wrapper
     child = wrapper.child
@@ -509,6 +736,61 @@ class SPMKernel(ProcessMetaKernel):
       self._first = False
       self.handle_plot_settings()
 
+    # $CACHE and $TABLE only concern the kernel and never reach SPM
+    if re.match("(?i)^ *\$(CACHE|TABLE)", code):
+      self.kernel_resp = {
+          'status': 'ok',
+          'execution_count': self.execution_count,
+          'payload': [],
+          'user_expressions': {},
+      }
+      if re.match("(?i)^ *\$CACHE", code):
+        message = self.cache_command(code)
+      else:
+        message = self.table_command(code)
+      if message:
+        return TextOutput(message)
+      return
+
+    # Look the cell up in the result cache.  ECHO only affects the kernel and
+    # QUIT restarts SPM, so neither is cached.
+    cell = code
+    key = None
+    if re.match("(?i)^ *QUI", code):
+      self._cache_history = ""
+      self._cache_pending = []
+    elif self.cache is not None and not re.match("(?i)^ *EC", code):
+      key = self.cache.key(cell, (__echo__, __table_rows__, self._cache_history))
+      entry = self.cache.get(key)
+      stale = None
+      if entry is not None:
+        stale = ResultCache.stale_files(entry)
+      if stale is not None:
+        self._cache_history = key
+        # SPM hasn't seen this cell, so before the next uncached one we give it the
+        # cell's session settings and load the groves it built, rather than building
+        # the models again.  Our own $ commands only display results.
+        if not re.match("^ *\$", code):
+          self._cache_pending.extend(ResultCache.state_commands(cell))
+          for path in ResultCache.grove_files(cell):
+            if path in entry["files"]:
+              self._cache_pending.append('grove "' + path + '"')
+        self.kernel_resp = {
+            'status': 'ok',
+            'execution_count': self.execution_count,
+            'payload': [],
+            'user_expressions': {},
+        }
+        return self.restore_cached(entry, stale, silent)
+    if key is None:
+      self._cache_history = ResultCache.digest(self._cache_history, cell)
+    else:
+      self._cache_history = key
+
+    # Bring SPM up to date with any cells that were restored from the cache
+    if self._cache_pending and not self.replay_cached():
+      return
+
     # We must have a carat prompt, so the ECHO command needs special processing
     if re.match("(?i)^ *EC", code):
       words = code.upper().split()
@@ -564,6 +846,18 @@ class SPMKernel(ProcessMetaKernel):
         stream_handler = None
     else:
       stream_handler = self.Print if not silent else None
+    if key is not None: # Capture the results of the cell so that they can be cached
+      self._cache_records = []
+      # Note the contents of the files the cell may write, so that we keep only those
+      # it actually changes.
+      before = {}
+      for path in ResultCache.output_files(cell):
+        before[path] = ResultCache.fingerprint(path)[-1]
+      if stream_handler:
+        printer = stream_handler
+        def stream_handler(text):
+          self._cache_records.append(("print", text))
+          printer(text)
     try:
       # Booby Trap:
       # output is empty unless no stream handler is defined
@@ -574,6 +868,8 @@ class SPMKernel(ProcessMetaKernel):
       interrupted = True
       output = wrapper.interrupt()
     except EOF:
+      self._cache_history = ""
+      self._cache_pending = []
       self.Print(child.before)
       self.do_shutdown(True)
       return
@@ -642,11 +938,33 @@ class SPMKernel(ProcessMetaKernel):
         except xml.parsers.expat.ExpatError:
           doc = {}
       os.remove(tmpname)
+    result = None
     if __echo__ and output:
       if stream_handler:
         stream_handler(output)
       else:
-        return TextOutput(output)
+        result = TextOutput(output)
+        if key is not None:
+          self._cache_records.append(("text", output))
+
+    # Store the results of a successful cell, along with any files it wrote
+    if key is not None:
+      records = self._cache_records
+      self._cache_records = None
+      text = output + "".join(record[1] for record in records if record[0] == "print")
+      # Silent runs print nothing, so they aren't stored for normal ones to restore
+      if not silent and not interrupted and self.kernel_resp['status'] == 'ok' and \
+         "*ERROR*" not in text:
+        files = {}
+        outputs = {}
+        for path in before:
+          after = ResultCache.fingerprint(path)[-1]
+          outputs[path] = (before[path], after)
+          if after is not None and after != before[path]:
+            with open(path, "rb") as fd:
+              files[path] = fd.read()
+        self.cache.put(key, {"records": records, "files": files, "outputs": outputs})
+    return result
 
   def handle_plot_settings(self):
     """Handle the current plot settings"""
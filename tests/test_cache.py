@@ -0,0 +1,94 @@
+# Tests for the cell result cache
+import os
+import sys
+
+from spm_kernel.cache import ResultCache
+
+
+def test_input_files_follow_submit(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  (tmp_path / "data.csv").write_text("X,Y\n1,2\n")
+  (tmp_path / "inner.cmd").write_text("use 'data.csv'\nsubmit 'outer.cmd'\n")
+  (tmp_path / "outer.cmd").write_text("submit \"inner.cmd\"\n")
+  names = ResultCache.input_files("submit outer.cmd")
+  assert str(tmp_path / "data.csv") in names
+  assert str(tmp_path / "inner.cmd") in names
+
+
+
+def test_output_files_follow_submit(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  (tmp_path / "model.cmd").write_text("grove 'tn.grv'\ntreenet go\nsave 'pred.csv'\n")
+  code = "submit 'model.cmd'"
+  assert ResultCache.output_files(code) == [str(tmp_path / "tn.grv"),
+                                            str(tmp_path / "pred.csv")]
+  assert ResultCache.grove_files(code) == [str(tmp_path / "tn.grv")]
+
+def test_key_changes_with_submitted_data(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  cache = ResultCache(str(tmp_path / "cache"), 1 << 20)
+  (tmp_path / "data.csv").write_text("X,Y\n1,2\n")
+  (tmp_path / "model.cmd").write_text("use data.csv\ncart go\n")
+  key = cache.key("submit 'model.cmd'", (True, ""))
+  assert key == cache.key("submit 'model.cmd'", (True, ""))
+  (tmp_path / "data.csv").write_text("X,Y\n1,3\n")
+  assert key != cache.key("submit 'model.cmd'", (True, ""))
+
+
+def test_output_files(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  code = "grove 'tn.grv'\noutliers 5\noutput 'log.dat'\nsave \"pred.csv\"\nsubmit x.cmd"
+  assert ResultCache.output_files(code) == [str(tmp_path / "tn.grv"),
+                                            str(tmp_path / "pred.csv")]
+
+
+def test_evict_least_recently_used(tmp_path):
+  cache = ResultCache(str(tmp_path), 250)
+  cache.put("a", {"records": [("text", "x" * 100)], "files": {}})
+  os.utime(cache.path("a"), (0, 0))
+  cache.put("b", {"records": [("text", "y" * 100)], "files": {}})
+  cache.put("c", {"records": [("text", "z" * 100)], "files": {}})
+  assert cache.get("a") is None
+  assert cache.get("c") is not None
+  assert cache.size() <= 250
+
+
+def test_state_commands_skip_builds(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  (tmp_path / "setup.cmd").write_text("keep x1 x2\ncart go\n")
+  code = "use 'data.csv'\n%let z = x1 + x2\nseed 1 2 3\nmart trees=200\n" \
+         "mart go\nsubmit setup.cmd\nautomate shaving\nbuild\ngrove 'tn.grv'"
+  assert ResultCache.state_commands(code) == \
+    ["use 'data.csv'", "%let z = x1 + x2", "seed 1 2 3", "mart trees=200", "keep x1 x2"]
+
+
+def test_stale_files(tmp_path):
+  grove = str(tmp_path / "tn.grv")
+  with open(grove, "w") as fd:
+    fd.write("built")
+  built = ResultCache.fingerprint(grove)[-1]
+  # A cell that grew the grove is restorable before it existed, or as the cell left it
+  entry = {"records": [], "files": {grove: b"built"}, "outputs": {grove: (None, built)}}
+  assert ResultCache.stale_files(entry) == []
+  os.remove(grove)
+  assert ResultCache.stale_files(entry) == [grove]
+  # ...but not once it has been rebuilt, since that would overwrite the new grove
+  with open(grove, "w") as fd:
+    fd.write("rebuilt")
+  assert ResultCache.stale_files(entry) is None
+  # A cell that only read the grove must miss once the grove changes
+  entry = {"records": [], "files": {}, "outputs": {grove: (built, built)}}
+  assert ResultCache.stale_files(entry) is None
+  assert ResultCache.stale_files({"records": [], "files": {}}) is None
+
+
+class Gone(object):
+  pass
+
+
+def test_unreadable_entry_is_a_miss(tmp_path, monkeypatch):
+  cache = ResultCache(str(tmp_path), 1 << 20)
+  cache.put("a", {"records": [("display", (Gone(),), {})], "files": {}, "outputs": {}})
+  monkeypatch.delattr(sys.modules[__name__], "Gone") # As if removed by an upgrade
+  assert cache.get("a") is None
+  assert cache.get("b") is None
@@ -0,0 +1,23 @@
+# Tests for the rendering of SPM tables
+import json
+
+from spm_kernel.kernel import TableOutput
+
+
+def test_long_tables_are_abbreviated():
+  body = [[str(i), " 0.5"] for i in range(100)]
+  table = TableOutput(" Summary", [" N", " Value"], body, [], 3)
+  html = table._repr_html_()
+  assert "94 rows omitted" in html
+  assert "<td>2</td>" in html and "<td>97</td>" in html and "<td>50</td>" not in html
+  assert len(table.resource()["data"]) == 6
+  assert len(TableOutput(" Summary", [" N", " Value"], body, []).resource()["data"]) == 100
+
+
+def test_resource_is_valid_json():
+  body = [["1", "nan", " x"], ["2.5", "inf", ""]]
+  resource = TableOutput(" T", [" A", " B", ""], body, []).resource()
+  assert [field["type"] for field in resource["schema"]["fields"]] == \
+    ["number", "string", "string"]
+  assert [field["name"] for field in resource["schema"]["fields"]] == ["A", "B", "Column 3"]
+  json.dumps(resource, allow_nan=False) # Raises ValueError on NaN or infinity
@@ -0,0 +1,102 @@
+# Tests for reading SPM output through the kernel's REPLWrapper
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+from spm_kernel.kernel import SPMKernel
+
+# Stand-in for spmu.  "big n" prints about n bytes of numbered lines, each with
+# " >" somewhere in the middle of it, then "end"; "keep" prints nothing at all;
+# anything else prints "ok".  Every command is followed by the " >" prompt.
+FAKE_SPM = """#!{python}
+import sys
+out = sys.stdout
+out.write("Fake SPM\\n >")
+out.flush()
+for command in sys.stdin:
+  words = command.split()
+  if words and words[0] == "big":
+    nbytes = int(words[1])
+    i = 0
+    while nbytes > 0:
+      line = "x" * (1 + i % 61) + " >= 5, AUC > 0.5 " + str(i) + "\\n"
+      out.write(line)
+      nbytes = nbytes - len(line) - 1 # The pty turns each "\\n" into "\\r\\n"
+      i = i + 1
+    out.write("end " + str(i) + "\\n")
+  elif words and words[0] == "keep":
+    pass
+  else:
+    out.write("ok\\n")
+  out.write(" >")
+  out.flush()
+"""
+
+
+@pytest.fixture
+def wrapper(tmp_path, monkeypatch):
+  spmu = tmp_path / "spmu"
+  spmu.write_text(FAKE_SPM.format(python=sys.executable))
+  spmu.chmod(spmu.stat().st_mode | stat.S_IXUSR)
+  monkeypatch.setenv("PATH", str(tmp_path) + os.pathsep + os.environ["PATH"])
+  kernel = SPMKernel.__new__(SPMKernel) # makeWrapper doesn't need a running kernel
+  wrapper = kernel.makeWrapper()
+  yield wrapper
+  wrapper.child.terminate(force=True)
+
+
+# Check that output from "big" arrived whole, and wasn't cut short at a " >"
+def check_output(output):
+  lines = output.splitlines()
+  assert lines[-1].startswith("end ")
+  assert len(lines) == int(lines[-1].split()[1]) + 1
+  assert all(" >= 5, AUC > 0.5 " in line for line in lines[:-1])
+
+
+def test_prompt(wrapper):
+  assert wrapper.run_command("use data.csv", timeout=None).strip() == "ok"
+
+
+def test_prompt_without_output(wrapper):
+  # With nothing before it, the prompt is at the very start of the buffer
+  assert wrapper.run_command("keep x1", timeout=10) == ""
+  assert wrapper.run_command("keep x2", timeout=10) == ""
+  assert wrapper.run_command("use data.csv", timeout=10).strip() == "ok"
+  chunks = []
+  wrapper.run_command("keep x3", timeout=10, stream_handler=chunks.append)
+  assert "".join(chunks) == ""
+  check_output(wrapper.run_command("big 100000", timeout=10))
+  assert wrapper.run_command("keep x4", timeout=10) == ""
+
+
+def test_prompt_in_output(wrapper):
+  check_output(wrapper.run_command("big 1000000", timeout=None))
+  assert wrapper.run_command("rem", timeout=None).strip() == "ok"
+
+
+def test_prompt_in_streamed_output(wrapper):
+  chunks = []
+  wrapper.run_command("big 1000000", timeout=None, stream_handler=chunks.append)
+  check_output("".join(chunks))
+  assert wrapper.run_command("rem", timeout=None).strip() == "ok"
+
+
+def test_throughput_is_linear(wrapper):
+  wrapper.run_command("big 100000", timeout=None) # Warm up
+  elapsed = {}
+  for mbytes in (1, 2, 4):
+    best = None
+    for trial in range(2):
+      start = time.time()
+      output = wrapper.run_command("big " + str(mbytes * 1000000), timeout=None)
+      seconds = time.time() - start
+      if best is None or seconds < best:
+        best = seconds
+    check_output(output)
+    elapsed[mbytes] = best
+  # Linear reading makes 4 MB take about 4 times as long as 1 MB (quadratic, 16).
+  assert elapsed[4] < 8 * elapsed[1], elapsed
+  assert elapsed[2] < 4 * elapsed[1], elapsed